@@ -4,19 +4,35 @@ Assembly: asm
 Set of helpers and functions. These functions are dependents of some config and setup
 """
 
+import io
 import re
-import six
 import copy
+import time
 import blinker
 import logging
 import inspect
+import warnings
+import threading
 import datetime
+import mimetypes
 import functools
 import itsdangerous
+import concurrent.futures
 import flask_cloudy
-from passlib.hash import bcrypt
+import passlib.exc
+from itsdangerous.encoding import (base64_decode, bytes_to_int)
+from passlib.context import CryptContext
+from passlib.hash import (argon2, bcrypt)
 from . import (app_context, ext, config, utils)
-from flask import (send_file, session, g)
+from .assembly import AssemblyError
+from flask import (send_file as f_send_file,
+                   session,
+                   g,
+                   Response,
+                   current_app,
+                   stream_with_context,
+                   has_app_context,
+                   has_request_context)
 
 __all__ = [
     "signal",
@@ -29,6 +45,7 @@ __all__ = [
     "download_file",
     "hash_string",
     "verify_hashed_string",
+    "hash_needs_update",
     "encode_jwt",
     "decode_jwt",
     "sign_data",
@@ -40,8 +57,81 @@ __all__ = [
 
 __signals_namespace = blinker.Namespace()
 
+# Runs the 'post' signals of emitters decorated with @signal(async_post=True)
+__signals_post_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4,
+                                                                thread_name_prefix="signal-post")
 
-def signal(fn):
+# Runs the post receivers of emitters decorated with @signal(parallel_post=True)
+__signals_receivers_executor = concurrent.futures.ThreadPoolExecutor(max_workers=8,
+                                                                     thread_name_prefix="signal-receiver")
+
+# Flags the threads currently running a receiver from __signals_receivers_executor
+__signals_receiver_local = threading.local()
+
+
+def _with_app_context(fn):
+    """
+    Bind the current app to fn, so it can run in another thread.
+    A new app context is pushed: flask.g is empty, and the request is not available.
+    The request context is not copied, as popping the copy would close
+    the request and run the teardown handlers while the view still uses it
+    :param fn: callable
+    :return: callable
+    """
+    if not has_app_context():
+        return fn
+    app = current_app._get_current_object()
+
+    def run(*a, **kw):
+        with app.app_context():
+            return fn(*a, **kw)
+    return run
+
+
+def _send_parallel(sig, sender, **kw):
+    """
+    Like blinker Signal.send(), but calls the receivers concurrently
+    and waits for all of them to complete.
+    When called from a receiver already running in the pool, ie: a receiver
+    calling another parallel_post emitter, the receivers are called serially,
+    so the pool doesn't wait on itself
+    :param sig: blinker.Signal
+    :param sender: the sender
+    :param kw: kwargs for the receivers
+    :return: list of (receiver, return value)
+    """
+    if getattr(__signals_receiver_local, "running", False):
+        return sig.send(sender, **kw)
+    receivers = list(sig.receivers_for(sender))
+    futures = [__signals_receivers_executor.submit(_run_receiver, _with_app_context(receiver), sender, **kw)
+               for receiver in receivers]
+    return [(receiver, future.result()) for receiver, future in zip(receivers, futures)]
+
+
+def _run_receiver(receiver, *a, **kw):
+    """
+    Run a receiver in __signals_receivers_executor, flagging the thread while it runs
+    :param receiver: callable
+    :return: the receiver return value
+    """
+    __signals_receiver_local.running = True
+    try:
+        return receiver(*a, **kw)
+    finally:
+        __signals_receiver_local.running = False
+
+
+def _log_signal_error(future):
+    """
+    Done callback for background signals, so receiver errors don't go unnoticed
+    :param future: concurrent.futures.Future
+    """
+    e = future.exception()
+    if e:
+        logging.error("Signal receiver error: %s" % e, exc_info=e)
+
+
+def signal(fn=None, async_post=False, parallel_post=False, sender=None):
     """
     @signal
     A decorator to mark a function as a signal emitter
@@ -85,15 +175,60 @@ def signal(fn):
     #3. Whenever the hello() function is run, i_run_before and i_run_after will be executed
     hello()
     hello()   
+
+    # Async post
+    To not block the caller on slow post receivers (mail, webhook, logging...),
+    the post signal can be sent from a thread pool. Pre signals are always sent inline.
+    The receivers run in a new app context: `current_app` is available, but
+    `request`, `session` and `flask.g` are not. Anything the receivers need
+    from the request must be part of the function arguments or result.
+
+    @signal(async_post=True)
+    def hello():
+      return 42
+
+    To not wait on each post receiver in turn, they can be called concurrently.
+    The caller still waits until all of them complete. As with async_post,
+    the receivers run in a new app context, without `request`, `session` or `flask.g`.
+
+    @signal(parallel_post=True)
+    def hello():
+      return 42
+
+    # Methods
+    For methods, pass an explicit sender name, which is used to name the signals
+
+    class Account(object):
+      @signal(sender="account.login")
+      def login(self):
+        pass
+
+    :param fn: the function to decorate
+    :param async_post: bool - to send the post signal in the background
+    :param parallel_post: bool - to call the post receivers concurrently
+    :param sender: string - a unique name for the signals. Required for methods
     """
+    if fn is None:
+        return functools.partial(signal,
+                                 async_post=async_post,
+                                 parallel_post=parallel_post,
+                                 sender=sender)
+
     ns = __signals_namespace
 
-    fnargs = inspect.getfullargspec(fn).args
-    fname = fn.__module__
-    if 'self' in fnargs or 'cls' in fnargs:
-        caller = inspect.currentframe().f_back
-        fname += "_" + caller.f_code.co_name
-    fname += "__" + fn.__name__
+    if sender:
+        fname = sender
+    else:
+        params = inspect.signature(fn).parameters
+        fname = fn.__module__
+        if 'self' in params or 'cls' in params:
+            warnings.warn("@signal on method '%s' without 'sender' is deprecated. "
+                          "Use @signal(sender=...)" % fn.__name__,
+                          DeprecationWarning,
+                          stacklevel=2)
+            caller = inspect.currentframe().f_back
+            fname += "_" + caller.f_code.co_name
+        fname += "__" + fn.__name__
 
     # pre and post
     fn.pre_ = ns.signal('pre_%s' % fname)
@@ -103,26 +238,37 @@ def signal(fn):
     fn.pre = fn.pre_.connect
     fn.post = fn.post_.connect
 
-    def send(action, *a, **kw):
-        sig_name = "%s_%s" % (action, fname)
-        result = kw.pop("result", None)
+    def send(sig, action, a, kw, result=None):
+        # nothing is listening, skip building the payload
+        if not sig.receivers:
+            return
         resp = {
             "args": a,
-            "kwargs": kw,
+            "kwargs": dict(kw),
             "name": fn.__name__,
             "signal": kw.get('self', kw.get('cls', fn))
         }
         if action == 'post':
-            ns.signal(sig_name).send(result, **resp)
+            if parallel_post:
+                _send_parallel(sig, result, **resp)
+            else:
+                sig.send(result, **resp)
         else:
-            ns.signal(sig_name).send(**resp)
+            sig.send(**resp)
 
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-        send('pre', *args, **kwargs)
+        # no receivers connected, just run the function
+        if not fn.pre_.receivers and not fn.post_.receivers:
+            return fn(*args, **kwargs)
+        send(fn.pre_, 'pre', args, kwargs)
         result = fn(*args, **kwargs)
-        kwargs["result"] = result
-        send('post', *args, **kwargs)
+        if async_post:
+            future = __signals_post_executor.submit(_with_app_context(send),
+                                                    fn.post_, 'post', args, kwargs, result=result)
+            future.add_done_callback(_log_signal_error)
+        else:
+            send(fn.post_, 'post', args, kwargs, result=result)
         return result
 
     return wrapper
@@ -130,21 +276,32 @@ def signal(fn):
 
 # ------------------------------------------------------------------------------
 
-def flash_data(data):
+def flash_data(data, persist=True):
     """
     Set temporary data in the session.
     It will replace the previous one
     :param data:
+    :param persist: bool - when False, the data is only kept for the current request,
+        in flask.g, and the session cookie is left untouched.
+        Use it when the data is read in the same request, not after a redirect
     :return:
     """
-    session["_flash_data"] = data
+    if persist:
+        session["_flash_data"] = data
+        g.pop("_flash_data", None)
+    else:
+        g._flash_data = data
+        if "_flash_data" in session:
+            del session["_flash_data"]
 
 
 def get_flashed_data():
     """
-    Retrieve and pop data from the session
+    Retrieve and pop data from the request or the session
     :return: mixed
     """
+    if "_flash_data" in g:
+        return g.pop("_flash_data")
     return session.pop("_flash_data", None)
 
 
@@ -185,10 +342,31 @@ def init_storage(app):
 def get_file(filename):
     """
     Get file from storage
+    The object is kept for the rest of the request,
+    so looking up the same file again doesn't hit the storage
     :param filename:
     :return: Storage object
     """
-    return storage.get(filename)
+    if not has_request_context():
+        return storage.get(filename)
+    files = g.setdefault("_storage_files", {})
+    if filename not in files:
+        obj = storage.get(filename)
+        if obj is None:
+            return None
+        files[filename] = obj
+    return files[filename]
+
+
+def _forget_file(name):
+    """
+    Remove a file from the get_file() cache
+    :param name: the object name
+    """
+    if has_request_context():
+        files = g.get("_storage_files", {})
+        for k in [k for k, obj in files.items() if k == name or obj.name == name]:
+            del files[k]
 
 
 @signal
@@ -234,19 +412,23 @@ def upload_file(file, props=None,  **kw):
     :param kw: extra **kw for upload
     :return: Storage object
     """
-    kwargs = {}
     if isinstance(props, str):
         conf = config.get("STORAGE_UPLOAD_FILE_PROPS")
         if not conf:
             raise ValueError("Missing STORAGE_UPLOAD_FILE_PROPS in config")
-        if props not in conf:
+        _props = conf.get(props)
+        if _props is None:
             raise ValueError("Missing '%s' properties in config STORAGE_UPLOAD_FILE_PROPS" % props)
-        kwargs.update(conf.get(props))
+        kwargs = {**_props, **kw}
     elif isinstance(props, dict):
-        kwargs.update(props)
-    kwargs.update(kw)
+        kwargs = {**props, **kw}
+    else:
+        kwargs = kw
 
-    return storage.upload(file, **kwargs)
+    obj = storage.upload(file, **kwargs)
+    if obj:
+        _forget_file(obj.name)
+    return obj
 
 
 @signal
@@ -268,6 +450,7 @@ def delete_file(fileobj, **kw):
 
     if not isinstance(fileobj, (flask_cloudy.Object, assembly_db.StorageObject)):
         raise TypeError("Invalid file type. Must be of flask_cloudy.Object or file doesn't exist")
+    _forget_file(fileobj.name)
     return fileobj.delete()
 
 @signal
@@ -300,12 +483,51 @@ def send_file(filename, content, as_attachment=True):
     :param timeout: the timeout to download file from the cloud
     :return:
     """
-    buff = six.BytesIO()
-    buff.write(content)
-    buff.seek(0)
-    return send_file(buff,
-                     attachment_filename=filename,
-                     as_attachment=as_attachment)
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    # BytesIO shares the initial bytes buffer, no extra copy is made
+    buff = io.BytesIO(content)
+    return f_send_file(buff,
+                       attachment_filename=filename,
+                       as_attachment=as_attachment)
+
+
+def send_file_stream(filename, content, mimetype=None, as_attachment=True, chunk_size=256 * 1024):
+    """
+    Like send_file, but streams the content to the client in chunks
+    instead of buffering it all in memory. Use it for large payloads.
+
+    # from a generator
+    send_file_stream("export.csv", (row_to_csv(r) for r in rows))
+
+    # from a binary file object. It will be closed when the response is done
+    send_file_stream("backup.zip", open(path, "rb"))
+
+    :param filename: the filename with extension.
+    :param content: iterable of bytes/str chunks, a binary file object, or string/bytes
+    :param mimetype: the mimetype. If None it will be guessed from the filename
+    :param as_attachment: to download as attachment
+    :param chunk_size: size of the chunks to read from a file object or bytes
+    :return: Response
+    """
+    close = getattr(content, "close", None)
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    if isinstance(content, (bytes, bytearray)):
+        data = content
+        content = (bytes(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size))
+    elif hasattr(content, "read"):
+        content = iter(functools.partial(content.read, chunk_size), b"")
+
+    if not mimetype:
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    resp = Response(stream_with_context(content), mimetype=mimetype)
+    # close the file object once the response is done
+    if close:
+        resp.call_on_close(close)
+    if as_attachment:
+        resp.headers.set("Content-Disposition", "attachment", filename=filename)
+    return resp
 
 # ------------------------------------------------------------------------------
 
@@ -314,8 +536,14 @@ __CRYPT = {}
 @app_context
 def __crypt_init(app):
     """
+    Passwords are hashed with Argon2id. Existing bcrypt hashes still verify,
+    and are reported by hash_needs_update() so they can be rehashed.
+    https://passlib.readthedocs.io/en/stable/lib/passlib.hash.argon2.html
     https://passlib.readthedocs.io/en/stable/lib/passlib.hash.bcrypt.html
     CONFIG
+        ARGON2_MEMORY_COST = 65536  # in KiB
+        ARGON2_TIME_COST = 2
+        ARGON2_PARALLELISM = 2
         BCRYPT_ROUNDS = 12  # salt string
         BCRYPT_SALT= None #
         BCRYPT_IDENT = '2b'
@@ -327,26 +555,86 @@ def __crypt_init(app):
         "rounds": config.get("BCRYPT_ROUNDS", 12)
     })
 
+    # Use the native backends, and build the context once
+    # instead of on every hash_string() call
+    try:
+        argon2.set_backend("argon2_cffi")
+        bcrypt.set_backend("bcrypt")
+    except passlib.exc.MissingBackendError as e:
+        raise AssemblyError("Missing 'argon2-cffi' or 'bcrypt' package for passlib. "
+                            "Install them with `pip install argon2-cffi bcrypt`: %s" % e)
+    except ValueError as e:
+        # passlib's backend self-test fails with bcrypt>=4.1
+        raise AssemblyError("Incompatible 'bcrypt' package for passlib. "
+                            "Install it with `pip install 'bcrypt<4.1'`: %s" % e)
+    __CRYPT["ctx"] = CryptContext(schemes=["argon2", "bcrypt"],
+                                  default="argon2",
+                                  deprecated=["bcrypt"],
+                                  argon2__type="ID",
+                                  argon2__memory_cost=config.get("ARGON2_MEMORY_COST", 65536),
+                                  argon2__time_cost=config.get("ARGON2_TIME_COST", 2),
+                                  argon2__parallelism=config.get("ARGON2_PARALLELISM", 2),
+                                  bcrypt__rounds=__CRYPT["rounds"])
+
+
+@functools.lru_cache(maxsize=32)
+def _derive_key(secret_key, salt, key_derivation, digest_method):
+    signer = itsdangerous.Signer(secret_key,
+                                 salt=salt,
+                                 key_derivation=key_derivation,
+                                 digest_method=digest_method)
+    return itsdangerous.Signer.derive_key(signer)
+
+
+class Signer2(itsdangerous.Signer):
+    """
+    Derives the signing key once per secret_key/salt,
+    instead of on every sign/unsign
+    """
 
-class TimestampSigner2(itsdangerous.TimestampSigner):
+    def derive_key(self):
+        return _derive_key(self.secret_key, self.salt, self.key_derivation, self.digest_method)
+
+
+class TimestampSigner2(Signer2, itsdangerous.TimestampSigner):
     expires_in = 0
 
     def get_timestamp(self):
-        now = datetime.datetime.utcnow()
-        expires_in = now + datetime.timedelta(seconds=self.expires_in)
-        return int(expires_in.strftime("%s"))
+        return int(time.time()) + self.expires_in
 
     @staticmethod
     def timestamp_to_datetime(ts):
-        return datetime.datetime.fromtimestamp(ts)
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
 
 
 class URLSafeTimedSerializer2(itsdangerous.URLSafeTimedSerializer):
     default_signer = TimestampSigner2
 
     def __init__(self, secret_key, expires_in=3600, salt=None, **kwargs):
-        self.default_signer.expires_in = expires_in
-        super(self.__class__, self).__init__(secret_key, salt=salt, **kwargs)
+        self.expires_in = expires_in
+        super(URLSafeTimedSerializer2, self).__init__(secret_key, salt=salt, **kwargs)
+
+    def make_signer(self, salt=None):
+        # expires_in is bound to the signer instance, not to the signer class,
+        # so serializers with different expiry don't step on each other
+        signer = super(URLSafeTimedSerializer2, self).make_signer(salt)
+        signer.expires_in = self.expires_in
+        return signer
+
+
+class URLSafeSerializer2(itsdangerous.URLSafeSerializer):
+    default_signer = Signer2
+
+
+def _signing_kwargs(kw):
+    """
+    Set the default secret_key and salt in the serializer kwargs
+    :param kw: dict
+    :return: dict
+    """
+    kw.setdefault("secret_key", __CRYPT.get("secret_key"))
+    kw.setdefault("salt", __CRYPT.get("salt"))
+    return kw
 
 
 def hash_string(string):
@@ -354,10 +642,7 @@ def hash_string(string):
     To hash a non versible hashed string. Can be used to hash password
     :returns: string
     """
-    conf = {
-        "rounds": __CRYPT.get("rounds")
-    }
-    return bcrypt.using(**conf).hash(string)
+    return __CRYPT["ctx"].hash(string)
 
 
 def verify_hashed_string(string, hash):
@@ -365,7 +650,21 @@ def verify_hashed_string(string, hash):
     check if string match its hashed. ie: To compare password
     :returns: bool
     """
-    return bcrypt.verify(string, hash)
+    return __CRYPT["ctx"].verify(string, hash)
+
+
+def hash_needs_update(hash):
+    """
+    Check if a hash was made with a deprecated scheme or settings, ie: bcrypt.
+    After a successful verify_hashed_string(), hash the string again and store it
+
+    if verify_hashed_string(password, user.password_hash):
+        if hash_needs_update(user.password_hash):
+            user.update(password_hash=hash_string(password))
+
+    :returns: bool
+    """
+    return __CRYPT["ctx"].needs_update(hash)
 
 
 def encode_jwt(data, expires_in=1, **kw):
@@ -377,10 +676,7 @@ def encode_jwt(data, expires_in=1, **kw):
     :return: string
     """
     expires_in *= 60
-    s = itsdangerous.TimedJSONWebSignatureSerializer(secret_key=__CRYPT.get("secret_key"),
-                                                     expires_in=expires_in,
-                                                     salt=__CRYPT.get("salt"),
-                                                     **kw)
+    s = itsdangerous.TimedJSONWebSignatureSerializer(expires_in=expires_in, **_signing_kwargs(kw))
     return s.dumps(data)
 
 
@@ -391,7 +687,7 @@ def decode_jwt(token, **kw):
     :param kw:
     :return: mixed data
     """
-    s = itsdangerous.TimedJSONWebSignatureSerializer(__CRYPT.get("secret_key"), salt=__CRYPT.get("salt"), **kw)
+    s = itsdangerous.TimedJSONWebSignatureSerializer(**_signing_kwargs(kw))
     return s.loads(token)
 
 
@@ -406,14 +702,9 @@ def sign_data(data, expires_in=None, **kw):
     """
     if expires_in:
         expires_in *= 60
-        s = URLSafeTimedSerializer2(secret_key=__CRYPT.get("secret_key"),
-                                    expires_in=expires_in,
-                                    salt=__CRYPT.get("salt"),
-                                    **kw)
+        s = URLSafeTimedSerializer2(expires_in=expires_in, **_signing_kwargs(kw))
     else:
-        s = itsdangerous.URLSafeSerializer(secret_key=__CRYPT.get("secret_key"),
-                                           salt=__CRYPT.get("salt"),
-                                           **kw)
+        s = URLSafeSerializer2(**_signing_kwargs(kw))
     return s.dumps(data)
 
 
@@ -427,17 +718,20 @@ def unsign_data(token,  **kw):
     :param kw:
     :return:
     """
-    if len(token.split(".")) == 3:
-        s = URLSafeTimedSerializer2(secret_key=__CRYPT.get("secret_key"), salt=__CRYPT.get("salt"), **kw)
-        value, timestamp = s.loads(token, max_age=None, return_timestamp=True)
-        now = datetime.datetime.utcnow()
+    if token.count(".") == 2:
+        s = URLSafeTimedSerializer2(**_signing_kwargs(kw))
+        value = s.loads(token, max_age=None)
+        # the signature is valid, read the expiry timestamp as int
+        timestamp = token.rsplit(".", 2)[1]
+        timestamp = bytes_to_int(base64_decode(timestamp))
+        now = int(time.time())
         if timestamp > now:
             return value
         else:
             raise itsdangerous.SignatureExpired(
                 'Signature age %s < %s ' % (timestamp, now),
                 payload=value,
-                date_signed=timestamp)
+                date_signed=TimestampSigner2.timestamp_to_datetime(timestamp))
     else:
-        s = itsdangerous.URLSafeSerializer(secret_key=__CRYPT.get("secret_key"), salt=__CRYPT.get("salt"), **kw)
+        s = URLSafeSerializer2(**_signing_kwargs(kw))
         return s.loads(token)
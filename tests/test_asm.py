@@ -0,0 +1,301 @@
+import io
+import pytest
+import threading
+import itsdangerous
+from flask import Flask, session, request, has_app_context, has_request_context
+from passlib.hash import bcrypt
+import assembly.asm as asm
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.secret_key = "secret"
+    return app
+
+
+def test_signal():
+    calls = []
+
+    @asm.signal
+    def hello(name):
+        return "hello %s" % name
+
+    @hello.pre
+    def before(*a, **kw):
+        calls.append(("pre", kw["args"]))
+
+    @hello.post
+    def after(result, **kw):
+        calls.append(("post", result))
+
+    assert hello("world") == "hello world"
+    assert calls == [("pre", ("world",)), ("post", "hello world")]
+
+
+def test_signal_without_receivers():
+
+    @asm.signal
+    def add(a, b=1):
+        return a + b
+
+    assert add(1) == 2
+    assert add(1, b=2) == 3
+
+
+def test_signal_kwargs():
+    received = {}
+
+    @asm.signal
+    def save(data, result=None):
+        return data
+
+    @save.post
+    def after(result, **kw):
+        received.update(kw["kwargs"])
+
+    assert save("x", result="keep") == "x"
+    assert received == {"result": "keep"}
+
+
+def test_signal_async_post():
+    done = threading.Event()
+    received = []
+
+    @asm.signal(async_post=True)
+    def greet(name):
+        return name
+
+    @greet.post
+    def after(result, **kw):
+        received.append(result)
+        done.set()
+
+    assert greet("world") == "world"
+    assert done.wait(5)
+    assert received == ["world"]
+
+
+def test_signal_async_post_request(app):
+    done = threading.Event()
+    received = []
+    teardowns = []
+    app.teardown_request(lambda e: teardowns.append(e))
+
+    @asm.signal(async_post=True)
+    def save_upload(f):
+        return f.filename
+
+    @save_upload.post
+    def after(result, **kw):
+        received.append((result, has_app_context(), has_request_context()))
+        done.set()
+
+    data = {"f": (io.BytesIO(b"abcdef"), "a.txt")}
+    with app.test_request_context(method="POST", data=data):
+        assert save_upload(request.files["f"]) == "a.txt"
+        assert done.wait(5)
+        assert received == [("a.txt", True, False)]
+        # the request is left untouched by the receiver thread
+        assert request.files["f"].read() == b"abcdef"
+        assert teardowns == []
+
+
+def test_send_file_stream(app):
+    with app.test_request_context():
+        resp = asm.send_file_stream("data.txt", b"abcdef", chunk_size=4)
+        assert resp.mimetype == "text/plain"
+        assert "attachment" in resp.headers["Content-Disposition"]
+        assert b"".join(resp.response) == b"abcdef"
+
+
+def test_urlsafe_timed_serializer_expires_in():
+    s1 = asm.URLSafeTimedSerializer2("secret", expires_in=60)
+    s2 = asm.URLSafeTimedSerializer2("secret", expires_in=3600)
+
+    assert s1.make_signer().expires_in == 60
+    assert s2.make_signer().expires_in == 3600
+    assert asm.TimestampSigner2.expires_in == 0
+    assert s2.make_signer().get_timestamp() - s1.make_signer().get_timestamp() >= 3539
+
+
+def test_signer_derive_key():
+    signer = asm.Signer2("secret", salt="salt")
+    key = signer.derive_key()
+    hits = asm._derive_key.cache_info().hits
+    assert asm.Signer2("secret", salt="salt").derive_key() == key
+    assert asm._derive_key.cache_info().hits == hits + 1
+    assert key == itsdangerous.Signer("secret", salt="salt").derive_key()
+
+
+def test_signal_sender():
+    calls = []
+
+    class Account(object):
+        @asm.signal(sender="account.login")
+        def login(self, name):
+            return name
+
+    @Account.login.pre
+    def before(*a, **kw):
+        calls.append(kw["args"][1])
+
+    assert Account().login("joe") == "joe"
+    assert calls == ["joe"]
+
+
+def test_signal_parallel_post():
+    barrier = threading.Barrier(2, timeout=5)
+    received = []
+
+    @asm.signal(parallel_post=True)
+    def notify(name):
+        return name
+
+    # each receiver waits for the other one, it only passes if they overlap
+    @notify.post
+    def after1(result, **kw):
+        barrier.wait()
+        received.append(1)
+
+    @notify.post
+    def after2(result, **kw):
+        barrier.wait()
+        received.append(2)
+
+    assert notify("joe") == "joe"
+    assert sorted(received) == [1, 2]
+
+
+def test_signal_parallel_post_request(app):
+    received = []
+    teardowns = []
+    app.teardown_request(lambda e: teardowns.append(e))
+
+    @asm.signal(parallel_post=True)
+    def store_upload(f):
+        return f.filename
+
+    @store_upload.post
+    def after1(result, **kw):
+        received.append((result, has_request_context()))
+
+    @store_upload.post
+    def after2(result, **kw):
+        received.append((result, has_request_context()))
+
+    data = {"f": (io.BytesIO(b"abcdef"), "a.txt")}
+    with app.test_request_context(method="POST", data=data):
+        assert store_upload(request.files["f"]) == "a.txt"
+        assert received == [("a.txt", False), ("a.txt", False)]
+        assert request.files["f"].read() == b"abcdef"
+        assert teardowns == []
+
+
+def test_signal_parallel_post_nested():
+    received = []
+
+    @asm.signal(parallel_post=True)
+    def inner(name):
+        return name
+
+    @asm.signal(parallel_post=True)
+    def outer(name):
+        return name
+
+    @inner.post
+    def after_inner(result, **kw):
+        received.append(result)
+
+    @outer.post
+    def after_outer(result, **kw):
+        inner(result)
+
+    assert outer("joe") == "joe"
+    assert received == ["joe"]
+
+
+def test_sign_data():
+    token = asm.sign_data({"id": 1}, secret_key="secret")
+    assert asm.unsign_data(token, secret_key="secret") == {"id": 1}
+
+    token = asm.sign_data({"id": 1}, expires_in=5, secret_key="secret")
+    assert asm.unsign_data(token, secret_key="secret") == {"id": 1}
+
+    token = asm.sign_data({"id": 1}, expires_in=-1, secret_key="secret")
+    with pytest.raises(itsdangerous.SignatureExpired):
+        asm.unsign_data(token, secret_key="secret")
+
+
+def test_flash_data(app):
+    with app.test_request_context():
+        asm.flash_data({"a": 1})
+        assert "_flash_data" in session
+        assert asm.get_flashed_data() == {"a": 1}
+        assert asm.get_flashed_data() is None
+
+        asm.flash_data({"b": 2}, persist=False)
+        assert "_flash_data" not in session
+        assert asm.get_flashed_data() == {"b": 2}
+        assert asm.get_flashed_data() is None
+
+
+def test_send_file_stream_file_object(app):
+    f = io.BytesIO(b"abcdef")
+
+    with app.test_request_context():
+        resp = asm.send_file_stream("data.bin", f, chunk_size=4)
+        assert resp.mimetype == "application/octet-stream"
+        assert b"".join(resp.response) == b"abcdef"
+        resp.close()
+        assert f.closed
+
+
+def test_hash_string(app, monkeypatch):
+    monkeypatch.setitem(asm.config, "SECRET_KEY", "secret")
+    monkeypatch.setattr(asm, "__CRYPT", {})
+    asm.__crypt_init(app)
+
+    hash = asm.hash_string("mypass123")
+    assert hash.startswith("$argon2id$")
+    assert asm.verify_hashed_string("mypass123", hash) is True
+    assert asm.verify_hashed_string("wrongpass", hash) is False
+    assert asm.hash_needs_update(hash) is False
+
+    old_hash = bcrypt.using(rounds=4).hash("mypass123")
+    assert asm.verify_hashed_string("mypass123", old_hash) is True
+    assert asm.verify_hashed_string("wrongpass", old_hash) is False
+    assert asm.hash_needs_update(old_hash) is True
+
+
+def test_get_file_cache(app, monkeypatch):
+    class Obj(object):
+        def __init__(self, name):
+            self.name = name
+
+    class Storage(object):
+        calls = 0
+
+        def get(self, name):
+            self.calls += 1
+            return Obj(name.lstrip("/"))
+
+        def upload(self, file, **kw):
+            return Obj(file)
+
+    storage = Storage()
+    monkeypatch.setattr(asm, "storage", storage)
+
+    with app.app_context():
+        asm.get_file("a.txt")
+        asm.get_file("a.txt")
+        assert storage.calls == 2
+
+    with app.test_request_context():
+        obj = asm.get_file("/a.txt")
+        assert asm.get_file("/a.txt") is obj
+        assert storage.calls == 3
+
+        asm.upload_file("a.txt")
+        assert asm.get_file("/a.txt") is not obj
+        assert storage.calls == 4